@@ -0,0 +1,181 @@
+"""Regression tests for scripts/matrix_to_ideogram_annots.py
+
+Run from the repository root:
+
+    python -m unittest discover -s tests/python
+"""
+
+import importlib.util
+import json
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+
+SCRIPT_PATH = os.path.join(os.path.dirname(__file__), '..', '..', 'scripts',
+                           'matrix_to_ideogram_annots.py')
+
+# Genes on chr1 and chr2 are interleaved, so annotations must be regrouped
+# by chromosome.  The gene named 'NA' must not be parsed as a missing value.
+INFERCNV_OUTPUT = (
+    '"PREVIZ.A.1"\t"PREVIZ.B.1"\t"PREVIZ.C.1"\t"PREVIZ.D.1"\n'
+    '"NA"\t0.5\t1.25\t-0.75\t2.0\n'
+    '"G2"\t1.0\t2.0\t3.0\t4.0\n'
+    '"G3"\t-1.5\t0.25\t0.125\t1.0\n'
+    '"G4"\t0.3\t0.6\t0.9\t1.2\n'
+)
+
+GEN_POS = (
+    'NA\tchr1\t100\t250\n'
+    'G2\tchr2\t10\t40\n'
+    'G3\tchr1\t300\t420\n'
+    'G4\tchr2\t50\t95\n'
+)
+
+CLUSTERS = {
+    'a': 'NAME\tX\tY\nTYPE\tnumeric\tnumeric\nhead\th\th\nA-1\t1\t2\nB-1\t1\t2\n',
+    'b': 'NAME\tX\tY\nTYPE\tnumeric\tnumeric\nhead\th\th\nC-1\t1\t2\nD-1\t1\t2\n'
+}
+
+# Output of the script before it was optimized, for the fixture above
+EXPECTED_KEYS = ['name', 'start', 'length', 'all', 'a', 'b']
+EXPECTED_ANNOTS = [
+    {'chr': 'chr1', 'annots': [['NA', 100, 150, 0.75, 1.25, 0.25],
+                               ['G3', 300, 120, -0.031, -0.25, 0.188]]},
+    {'chr': 'chr2', 'annots': [['G2', 10, 30, 2.5, 2.5, 2.5],
+                               ['G4', 50, 45, 0.75, 0.75, 0.75]]}
+]
+
+
+def load_script(missing=()):
+    """Import the script as a fresh module, hiding the named modules"""
+    # Only restore the hidden entries afterwards; mock.patch.dict would also
+    # drop modules first imported by the script, which numpy can't reload
+    saved = {name: sys.modules.get(name) for name in missing}
+    sys.modules.update(dict.fromkeys(missing))
+    try:
+        spec = importlib.util.spec_from_file_location(
+            'matrix_to_ideogram_annots', SCRIPT_PATH)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        for name, saved_module in saved.items():
+            if saved_module is None:
+                del sys.modules[name]
+            else:
+                sys.modules[name] = saved_module
+    return module
+
+
+class MatrixToIdeogramAnnotsTest(unittest.TestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.dir = tmp_dir.name
+
+        self.infercnv_output = self.write_file('pre_vis_transform.txt',
+                                               INFERCNV_OUTPUT)
+        self.gen_pos_file = self.write_file('gen_pos.txt', GEN_POS)
+        self.cluster_paths = {
+            name: self.write_file(name + '.txt', content)
+            for name, content in CLUSTERS.items()
+        }
+
+    def write_file(self, name, content):
+        path = os.path.join(self.dir, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def run_script(self, module, binary=False):
+        output_file = os.path.join(self.dir, 'annots.json')
+        clusters_meta = module.get_clusters_meta(
+            list(self.cluster_paths), list(self.cluster_paths.values()))
+        with mock.patch('builtins.print'):
+            module.MatrixToIdeogramAnnots(self.infercnv_output, '\t',
+                                          self.gen_pos_file, clusters_meta,
+                                          output_file, binary)
+        with open(output_file) as f:
+            return output_file, json.load(f)
+
+    def assert_annots_equal(self, annots, expected):
+        self.assertEqual([c['chr'] for c in annots],
+                         [c['chr'] for c in expected])
+        for chr_annots, expected_chr_annots in zip(annots, expected):
+            self.assertEqual(len(chr_annots['annots']),
+                             len(expected_chr_annots['annots']))
+            for annot, expected_annot in zip(chr_annots['annots'],
+                                             expected_chr_annots['annots']):
+                self.assertEqual(annot[:3], expected_annot[:3])
+                np.testing.assert_allclose(annot[3:], expected_annot[3:])
+
+    def check_json_output(self, module):
+        _, annots = self.run_script(module)
+        self.assertEqual(annots['keys'], EXPECTED_KEYS)
+        self.assert_annots_equal(annots['annots'], EXPECTED_ANNOTS)
+
+    def test_json_output(self):
+        self.check_json_output(load_script())
+
+    def test_json_output_without_numba(self):
+        module = load_script(missing=['numba'])
+        self.assertIsNone(module.compute_group_means)
+        self.check_json_output(module)
+
+    def test_json_output_with_stdlib_json(self):
+        module = load_script(missing=['orjson', 'msgspec', 'msgspec.json'])
+        self.assertEqual(module.dumps_json.__module__, module.__name__)
+        self.check_json_output(module)
+
+    def test_binary_output(self):
+        output_file, manifest = self.run_script(load_script(), binary=True)
+
+        self.assertEqual(manifest['keys'], EXPECTED_KEYS)
+        self.assertEqual(manifest['means'], {
+            'file': 'annots.means.f32',
+            'dtype': 'float32',
+            'shape': [4, 3]
+        })
+        self.assertEqual(manifest['annots'], [
+            {'chr': 'chr1', 'offset': 0, 'names': ['NA', 'G3'],
+             'starts': [100, 300], 'lengths': [150, 120]},
+            {'chr': 'chr2', 'offset': 2, 'names': ['G2', 'G4'],
+             'starts': [10, 50], 'lengths': [30, 45]}
+        ])
+
+        # Rows follow the manifest: grouped by chromosome, not input order
+        means_file = os.path.join(os.path.dirname(output_file),
+                                  manifest['means']['file'])
+        means = np.fromfile(means_file, dtype='<f4').reshape(4, 3)
+        expected_means = [annot[3:] for chr_annots in EXPECTED_ANNOTS
+                          for annot in chr_annots['annots']]
+        np.testing.assert_allclose(means, expected_means, rtol=1e-6)
+
+    def test_output_across_chunks(self):
+        module = load_script()
+        get_matrix = module.MatrixToIdeogramAnnots.get_expression_matrix_dict
+        # Read 3 genes at a time, so the 4 genes span 2 chunks
+        with mock.patch.object(get_matrix, '__defaults__', (3,)):
+            self.check_json_output(module)
+
+    def test_header_only_output(self):
+        self.write_file('pre_vis_transform.txt',
+                        INFERCNV_OUTPUT.splitlines(True)[0])
+
+        _, annots = self.run_script(load_script())
+        self.assertEqual(annots, {'keys': EXPECTED_KEYS, 'annots': []})
+
+        output_file, manifest = self.run_script(load_script(), binary=True)
+        self.assertEqual(manifest['means']['shape'], [0, 3])
+        self.assertEqual(manifest['annots'], [])
+        means_file = os.path.join(os.path.dirname(output_file),
+                                  manifest['means']['file'])
+        self.assertEqual(os.path.getsize(means_file), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()